@@ -1,8 +1,17 @@
+import argparse
 import asyncio
-import json
+import orjson
 from pprint import pprint
 import logging
 
+from protocol import send_message, read_message
+
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 8888
+
+# Commands that never change are encoded once at import time
+PING_PAYLOAD = orjson.dumps({"command": "ping", "data": {}})
+
 
 class VM:
     def __init__(self, vm_id=None, password=None, ram=None, cpu=None, disks=None, reader=None, writer=None):
@@ -15,14 +24,31 @@ class VM:
         self.writer = writer
         self.auth_token = ''
 
+    async def connect(self, host=SERVER_HOST, port=SERVER_PORT):
+        """ Opens the connection that is reused by every command of this VM """
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+
+    async def close(self):
+        """ Closes the connection to the server """
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except ConnectionError:
+                # The connection is already broken, closing it is all that was needed
+                pass
+
     async def send_command(self, command):
-        self.writer.write(json.dumps(command).encode())
-        await self.writer.drain()
+        return await self.send_payload(orjson.dumps(command))
+
+    async def send_payload(self, payload: bytes):
+        """ Sends an already encoded command and returns the decoded server response """
+        await send_message(self.writer, payload)
 
-        data = await self.reader.read(4096)
+        data = await read_message(self.reader)
         try:
-            json_data = json.loads(data.decode())
-        except json.JSONDecodeError:
+            json_data = orjson.loads(data)
+        except orjson.JSONDecodeError:
             json_data = dict()
 
         logging.info("Server response: ")
@@ -30,14 +56,19 @@ class VM:
         return json_data
 
     async def ping(self):
+        await self.send_payload(PING_PAYLOAD)
+
+    async def send_batch(self, commands: list) -> list:
+        """ Sends several commands in one round-trip and returns their responses in the same order """
         command = {
-            "command": "ping",
-            "data": {}
+            "command": "batch",
+            "data": {"requests": commands}
         }
-        await self.send_command(command)
+        json_data = await self.send_command(command)
+        return json_data.get('data', {}).get('responses', [])
 
-    async def register(self):
-        command = {
+    def register_command(self):
+        return {
             "command": "register",
             "data": {
                 "vm_id": self.vm_id,
@@ -47,21 +78,34 @@ class VM:
                 "disks": self.disks
             }
         }
-        await self.send_command(command)
 
-    async def authenticate(self):
-        command = {
+    def authenticate_command(self):
+        return {
             "command": "authenticate",
             "data": {
                 "vm_id": self.vm_id,
                 "password": self.password
             }
         }
-        json_data = await self.send_command(command)
-        auth_token = json_data.get('data', {}).get('token')
+
+    def save_token(self, json_data):
+        auth_token = (json_data.get('data') or {}).get('token')
         if auth_token:
             self.auth_token = auth_token
 
+    async def register(self):
+        await self.send_command(self.register_command())
+
+    async def authenticate(self):
+        json_data = await self.send_command(self.authenticate_command())
+        self.save_token(json_data)
+
+    async def register_and_authenticate(self):
+        """ Registers the VM and authenticates it in a single batch request """
+        responses = await self.send_batch([self.register_command(), self.authenticate_command()])
+        if len(responses) == 2:
+            self.save_token(responses[1])
+
     async def list(self, list_type):
         command = {
             "command": "list",
@@ -96,40 +140,65 @@ class VM:
         self.auth_token = ''
 
 
-async def main():
-    # Create the VM instance
-    vm = None
+async def ainput(prompt: str) -> str:
+    """ Reads a line from stdin in a worker thread, so the event loop is not blocked while waiting for the user """
+    return await asyncio.to_thread(input, prompt)
+
+
+async def input_disks(count_prompt: str, size_prompt: str) -> list:
+    disks = []
+    num_disks = int(await ainput(count_prompt))
+    for i in range(num_disks):
+        disk_size = int(await ainput(f"{size_prompt} {i + 1}: "))
+        disks.append({"disk_size": disk_size})
+    return disks
 
+
+def parse_disks(value: str) -> list:
+    return [{"disk_size": int(size)} for size in value.split(",") if size.strip()]
+
+
+def parse_args() -> argparse.Namespace:
+    """ VM parameters can be passed as arguments, the ones that are missing are asked for interactively """
+    parser = argparse.ArgumentParser(description="Virtual machine client")
+    parser.add_argument("--vm-id", help="VM identifier")
+    parser.add_argument("--password", help="VM password")
+    parser.add_argument("--ram", type=int, help="RAM size for the VM")
+    parser.add_argument("--cpu", type=int, help="Number of CPUs for the VM")
+    parser.add_argument("--disks", type=parse_disks, help="Comma separated disk sizes, e.g. 100,200")
+    return parser.parse_args()
+
+
+async def main(args: argparse.Namespace):
     # Input for creating VM
-    while vm is None:
-        vm_id = input("Enter VM ID: ")
-        password = input("Enter VM password: ")
+    vm_id = args.vm_id or await ainput("Enter VM ID: ")
+    password = args.password or await ainput("Enter VM password: ")
 
-        ram = int(input("Enter RAM size for VM: "))
-        cpu = int(input("Enter number of CPUs for VM: "))
+    ram = args.ram if args.ram is not None else int(await ainput("Enter RAM size for VM: "))
+    cpu = args.cpu if args.cpu is not None else int(await ainput("Enter number of CPUs for VM: "))
 
-        disks = []
-        num_disks = int(input("Enter number of disks: "))
-        for i in range(num_disks):
-            disk_size = int(input(f"Enter size for disk {i + 1}: "))
-            disks.append({"disk_size": disk_size})
+    disks = args.disks
+    if disks is None:
+        disks = await input_disks("Enter number of disks: ", "Enter size for disk")
 
-        # Create VM object
-        reader, writer = await asyncio.open_connection('127.0.0.1', 8888)
-        vm = VM(vm_id, password, ram, cpu, disks, reader, writer)
-        logging.info(f"VM created with ID {vm_id}.")
+    # Create the VM instance
+    vm = VM(vm_id, password, ram, cpu, disks)
+    await vm.connect()
+    logging.info("VM created with ID %s.", vm_id)
 
     # Main loop to handle commands
     while True:
         try:
-            command = input(
-                "\nEnter command (register, authenticate, list_active, list_authenticated, list_all, list_all_disks, update, logout, exit): \n"
-            ).lower().strip()
+            command = (await ainput(
+                "\nEnter command (register, authenticate, register_authenticate, list_active, list_authenticated, list_all, list_all_disks, update, logout, exit): \n"
+            )).lower().strip()
 
             if command == "register":
                 await vm.register()
             elif command == "authenticate":
                 await vm.authenticate()
+            elif command == "register_authenticate":
+                await vm.register_and_authenticate()
             elif command == "list_active":
                 await vm.list("active_vms")
             elif command == "list_authenticated":
@@ -139,13 +208,9 @@ async def main():
             elif command == "list_all_disks":
                 await vm.list("all_disks")
             elif command == "update":
-                new_ram = int(input("Enter new RAM size for VM: "))
-                new_cpu = int(input("Enter new number of CPUs for VM: "))
-                new_disks = []
-                num_new_disks = int(input("Enter number of updated disks: "))
-                for i in range(num_new_disks):
-                    disk_size = int(input(f"Enter new size for disk {i + 1}: "))
-                    new_disks.append({"disk_size": disk_size})
+                new_ram = int(await ainput("Enter new RAM size for VM: "))
+                new_cpu = int(await ainput("Enter new number of CPUs for VM: "))
+                new_disks = await input_disks("Enter number of updated disks: ", "Enter new size for disk")
                 await vm.update(ram=new_ram, cpu=new_cpu, disks=new_disks)
             elif command == "logout":
                 await vm.logout()
@@ -154,10 +219,14 @@ async def main():
                 break
             else:
                 logging.info("Unknown command. Try again.")
-        except ConnectionResetError as e:
-            logging.info(e, "Trying to reconnect...")
-            vm.reader, vm.writer = await asyncio.open_connection('127.0.0.1', 8888)
+        except (ConnectionResetError, asyncio.IncompleteReadError, ValueError) as e:
+            # ValueError also comes from a frame over the size limit, the stream can't be read past it
+            logging.info("%s. Trying to reconnect...", e)
+            await vm.close()
+            await vm.connect()
+
+    await vm.close()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    asyncio.run(main(parse_args()))
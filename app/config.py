@@ -1,6 +1,7 @@
 import os
 
 SECRET_KEY = "who_is_the_best_snake_dev"
+TOKEN_TTL = int(os.getenv("TOKEN_TTL", "3600"))  # Access token lifetime in seconds
 
 DB_CONFIG = {
     "host": os.getenv("DB_HOST", "localhost"),
@@ -8,4 +9,19 @@ DB_CONFIG = {
     "user": os.getenv("DB_USER", "admin"),
     "password": os.getenv("DB_PASSWORD", "admin"),
     "database": os.getenv("DB_NAME", "vm_manager"),
-}
\ No newline at end of file
+}
+
+# Requests allowed in one batch command. They run one after another, so a batch holds its connection until all are done
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "20"))
+
+# bcrypt work factor. Every extra round doubles the hashing time
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# Threads hashing and checking passwords. bcrypt releases the GIL, so each one can use a separate core
+BCRYPT_WORKERS = int(os.getenv("BCRYPT_WORKERS", os.cpu_count() or 1))
+
+# Authentication attempts allowed from one host per period in seconds. Every attempt costs a bcrypt check
+AUTH_RATE_LIMIT = int(os.getenv("AUTH_RATE_LIMIT", "5"))
+AUTH_RATE_PERIOD = float(os.getenv("AUTH_RATE_PERIOD", "1"))
+
+# Clients connected at the same time. Connections over the limit are refused with an error message
+MAX_CLIENTS = int(os.getenv("MAX_CLIENTS", "1024"))
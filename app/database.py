@@ -1,17 +1,46 @@
-from typing import Optional
+import asyncio
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Optional
 
 import asyncpg
 import bcrypt
 import logging
 
-from schemes import Disk, UpdateVM, VM
-from config import DB_CONFIG
-
-logging.basicConfig(level=logging.DEBUG)
+from schemes import DiskRecord, UpdateVM, VM, VMRecord
+from config import DB_CONFIG, BCRYPT_ROUNDS, BCRYPT_WORKERS
+
+log = logging.getLogger(__name__)
+
+# The queries are kept as constants: asyncpg prepares every distinct query text once per connection and
+# reuses the prepared statement from the connection's cache on later calls, also after the pool hands it out again
+SELECT_VMS_QUERY = 'SELECT vm_id, ram, cpu, password FROM virtual_machines WHERE vm_id = ANY($1::text[])'
+SELECT_ALL_VMS_QUERY = 'SELECT vm_id, ram, cpu, password FROM virtual_machines'
+SELECT_DISKS_QUERY = 'SELECT id, vm_id, disk_size FROM disks WHERE vm_id = ANY($1::text[])'
+SELECT_ALL_DISKS_QUERY = 'SELECT id, vm_id, disk_size FROM disks'
+SELECT_PUBLIC_VMS_WITH_DISKS_QUERY = '''
+    SELECT vms.vm_id, vms.ram, vms.cpu, disks.id AS disk_id, disks.disk_size
+    FROM virtual_machines vms LEFT JOIN disks ON disks.vm_id = vms.vm_id
+    ORDER BY vms.vm_id, disks.id
+'''
+INSERT_VM_QUERY = '''
+    WITH new_vm AS (
+        INSERT INTO virtual_machines (vm_id, ram, cpu, password) VALUES ($1, $2, $3, $4)
+        RETURNING vm_id
+    )
+    INSERT INTO disks (vm_id, disk_size)
+    SELECT new_vm.vm_id, sizes.disk_size FROM new_vm, UNNEST($5::integer[]) AS sizes(disk_size)
+'''
+UPDATE_VM_QUERY = 'UPDATE virtual_machines SET ram = COALESCE($1, ram), cpu = COALESCE($2, cpu) WHERE vm_id = $3'
+INSERT_DISK_QUERY = 'INSERT INTO disks (vm_id, disk_size) VALUES ($1, $2)'
+DELETE_DISKS_QUERY = 'DELETE FROM disks WHERE vm_id=$1'
+COPY_DISKS_THRESHOLD = 100  # Number of disks from which update_vm inserts them with COPY
 
 
 class DbPool:
     db_pool: Optional[asyncpg.pool.Pool] = None
+    # Guards the first pool creation so concurrent first requests don't create several pools
+    _lock = asyncio.Lock()
 
     @staticmethod
     async def create_pool() -> asyncpg.pool.Pool:
@@ -21,28 +50,39 @@ class DbPool:
             user=DB_CONFIG["user"],
             password=DB_CONFIG["password"],
             database=DB_CONFIG["database"],
-            max_size=10
+            min_size=2,
+            max_size=10,
+            max_inactive_connection_lifetime=60,
+            # Sent with the connection startup packet, so it costs no extra round-trip. The queries here are
+            # short lookups where compiling a plan with LLVM takes longer than running it
+            server_settings={"jit": "off"}
         )
         return pool
 
     @staticmethod
     async def get_pool() -> asyncpg.pool.Pool:
-        if not DbPool.db_pool:
-            DbPool.db_pool = await DbPool.create_pool()
+        if DbPool.db_pool is None:
+            async with DbPool._lock:
+                if DbPool.db_pool is None:
+                    DbPool.db_pool = await DbPool.create_pool()
         return DbPool.db_pool
 
     @staticmethod
     async def terminate_pool() -> None:
         (await DbPool.get_pool()).terminate()
         DbPool.db_pool = None
-        logging.info("Pool terminated")
+        log.info("Pool terminated")
 
 
 class PasswordHandler:
+    # bcrypt releases the GIL, so hashing in these threads runs in parallel with the event loop.
+    # A dedicated pool keeps slow hashes from starving other users of the default executor
+    executor = ThreadPoolExecutor(max_workers=BCRYPT_WORKERS, thread_name_prefix="bcrypt")
+
     @staticmethod
     def hash_password(password: str) -> str:
         """Hash a password before storing it in the database."""
-        salt = bcrypt.gensalt()
+        salt = bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
         hashed_password = bcrypt.hashpw(password.encode(), salt)
         return hashed_password.decode()
 
@@ -51,6 +91,20 @@ class PasswordHandler:
         """Check if the given password matches the stored hash."""
         return bcrypt.checkpw(password.encode(), hashed_password.encode())
 
+    @staticmethod
+    async def hash_password_async(password: str) -> str:
+        """Hash a password in the bcrypt thread pool without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(PasswordHandler.executor, PasswordHandler.hash_password, password)
+
+    @staticmethod
+    async def verify_password_async(password: str, hashed_password: str) -> bool:
+        """Check a password in the bcrypt thread pool without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            PasswordHandler.executor, PasswordHandler.verify_password, password, hashed_password
+        )
+
 
 class DatabaseManager:
     """ Basic queries for managing the database"""
@@ -76,107 +130,94 @@ class DatabaseManager:
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 );
             ''')
-            logging.info("Initialized database tables")
+            # Disks are always looked up by their vm, the foreign key alone doesn't create an index for it
+            await conn.execute('CREATE INDEX IF NOT EXISTS idx_disks_vm_id ON disks(vm_id)')
+            log.info("Initialized database tables")
 
     @staticmethod
-    async def get_vm(pool: asyncpg.pool.Pool, vm_id: str) -> VM | None:
+    async def get_vm(pool: asyncpg.pool.Pool, vm_id: str) -> VMRecord | None:
+        vms = await DatabaseManager.get_vms(pool, [vm_id])
+        return vms[0] if vms else None
+
+    @staticmethod
+    async def get_vms(pool: asyncpg.pool.Pool, vm_ids: list = None) -> list[VMRecord]:
         async with pool.acquire() as conn:
-            vm_db = await conn.fetchrow(
-                'SELECT vm_id, ram, cpu, password FROM virtual_machines WHERE vm_id=$1', vm_id
-            )
-            if not vm_db:
-                return None
+            if vm_ids:
+                vms_db = await conn.fetch(SELECT_VMS_QUERY, vm_ids)
+                disks = await conn.fetch(SELECT_DISKS_QUERY, vm_ids)
+            else:
+                vms_db = await conn.fetch(SELECT_ALL_VMS_QUERY)
+                disks = await conn.fetch(SELECT_ALL_DISKS_QUERY)
 
-            disks_objects = []
-            disks = await conn.fetch(
-                'SELECT id, disk_size FROM disks WHERE vm_id=$1', vm_id
-            )
-            for disk in disks:
-                disks_objects.append(Disk(id=disk['id'], vm_id=vm_id, disk_size=disk["disk_size"]))
+        # Group the disks by vm in one pass instead of querying them for every vm
+        # Records are unpacked by position, which is cheaper than looking every column up by name
+        disks_by_vm = defaultdict(list)
+        for disk_id, vm_id, disk_size in disks:
+            disks_by_vm[vm_id].append(DiskRecord(disk_id, vm_id, disk_size))
 
-            return VM(
-                vm_id=vm_db['vm_id'], ram=vm_db['ram'], cpu=vm_db['cpu'], password=vm_db['password'],
-                disks=disks_objects
-            )
+        return [
+            VMRecord(vm_id, ram, cpu, password, disks_by_vm[vm_id])
+            for vm_id, ram, cpu, password in vms_db
+        ]
 
     @staticmethod
-    async def get_vms(pool: asyncpg.pool.Pool, vm_ids: list = None) -> list[VM] | None:
+    async def iter_public_vms(pool: asyncpg.pool.Pool) -> AsyncIterator[dict]:
+        """
+        Streams the public info of all virtual machines with their disks through a server-side cursor,
+        so only one vm at a time is kept in memory instead of the whole table.
+        The password hashes are not selected, and the info is built straight from the rows
+        in the same shape as VMRecord.public_info
+        """
         async with pool.acquire() as conn:
-            vms = []
-            if vm_ids:
-                vms_db = await conn.fetch('SELECT vm_id, ram, cpu, password FROM virtual_machines where vm_id in $1',
-                                          vm_ids)
-            else:
-                vms_db = await conn.fetch('SELECT vm_id, ram, cpu, password FROM virtual_machines')
-
-            for vm_db in vms_db:
-                disks = await conn.fetch(
-                    'SELECT id, disk_size FROM disks WHERE vm_id=$1', vm_db['vm_id']
-                )
-                disks_objects = []
-                for disk in disks:
-                    disks_objects.append(
-                        Disk(id=disk['id'], vm_id=vm_db['vm_id'], disk_size=disk["disk_size"])
-                    )
-
-                vm = VM(
-                    vm_id=vm_db['vm_id'], ram=vm_db['ram'],
-                    cpu=vm_db['cpu'], password=vm_db['password'], disks=disks_objects
-                )
-                vms.append(vm)
-
-            return vms
+            async with conn.transaction():
+                vm = None
+                # Rows come ordered by vm, so a vm is complete once the next one starts
+                async for vm_id, ram, cpu, disk_id, disk_size in conn.cursor(SELECT_PUBLIC_VMS_WITH_DISKS_QUERY):
+                    if vm is None or vm["vm_id"] != vm_id:
+                        if vm is not None:
+                            yield vm
+                        vm = {"vm_id": vm_id, "ram": ram, "cpu": cpu, "disks": []}
+
+                    if disk_id is not None:
+                        vm["disks"].append(DiskRecord(disk_id, vm_id, disk_size))
+
+                if vm is not None:
+                    yield vm
 
     @staticmethod
     async def create_vm(pool: asyncpg.pool.Pool, vm: VM):
-        vm.password = PasswordHandler.hash_password(vm.password)
+        vm.password = await PasswordHandler.hash_password_async(vm.password)
+        # The vm and its disks are inserted by one statement, so they are saved atomically in a single round-trip
         async with pool.acquire() as conn:
             await conn.execute(
-                'INSERT INTO virtual_machines (vm_id, ram, cpu, password) VALUES ($1, $2, $3, $4)',
-                vm.vm_id, vm.ram, vm.cpu, vm.password
+                INSERT_VM_QUERY, vm.vm_id, vm.ram, vm.cpu, vm.password, [disk.disk_size for disk in vm.disks]
             )
 
-        for disk in vm.disks:
-            disk.vm_id = vm.vm_id
-            await DatabaseManager.create_disk(pool, disk)
-
     @staticmethod
     async def update_vm(pool: asyncpg.pool.Pool, vm_id: str, new_vm: UpdateVM) -> None:
-        # Build dynamic SQL query for updating only the field with new data
-        update_fields = new_vm.model_dump(exclude_none=True, exclude={'addr', 'token', 'disks'})
-        if not update_fields:
+        if new_vm.ram is None and new_vm.cpu is None and new_vm.disks is None:
             raise ValueError("No fields for update")
 
-        set_clause = ", ".join([f"{field}=${i + 1}" for i, field in enumerate(update_fields.keys())])
-        set_values = list(update_fields.values()) + [vm_id]
-
-        query = f"UPDATE virtual_machines SET {set_clause} WHERE vm_id=${len(set_values)}"
-        delete_old_disks_query = f"DELETE FROM disks WHERE vm_id=$1"
-        create_new_disk_query = f"INSERT INTO disks (vm_id, disk_size) VALUES ($1, $2)"
-
         async with pool.acquire() as conn:
             async with conn.transaction():
-                await conn.execute(query, *set_values)
-                await conn.execute(delete_old_disks_query, vm_id)
-                for disk in new_vm.disks:
-                    await conn.execute(create_new_disk_query, vm_id, disk.disk_size)
+                # Fields sent as None keep their value, so one statement covers every combination of fields
+                if new_vm.ram is not None or new_vm.cpu is not None:
+                    await conn.execute(UPDATE_VM_QUERY, new_vm.ram, new_vm.cpu, vm_id)
+                if new_vm.disks is not None:
+                    await conn.execute(DELETE_DISKS_QUERY, vm_id)
+                    disks = [(vm_id, disk.disk_size) for disk in new_vm.disks]
+                    # COPY sends all rows in one binary stream, but has its own setup round-trips,
+                    # so it only pays off for long disk lists
+                    if len(disks) > COPY_DISKS_THRESHOLD:
+                        await conn.copy_records_to_table('disks', records=disks, columns=('vm_id', 'disk_size'))
+                    else:
+                        await conn.executemany(INSERT_DISK_QUERY, disks)
 
     @staticmethod
-    async def create_disk(pool: asyncpg.pool.Pool, disk: Disk):
+    async def get_disks(pool: asyncpg.pool.Pool) -> list[asyncpg.Record]:
+        """
+        Returns the disk rows as asyncpg records. They are only sent to clients,
+        and the serializer reads them as mappings without copying each one into a new object
+        """
         async with pool.acquire() as conn:
-            await conn.execute(
-                'INSERT INTO disks (vm_id, disk_size) VALUES ($1, $2)',
-                disk.vm_id, disk.disk_size
-            )
-
-    @staticmethod
-    async def get_disks(pool: asyncpg.pool.Pool):
-        async with pool.acquire() as conn:
-            disks = await conn.fetch(
-                'SELECT id, vm_id, disk_size FROM disks'
-            )
-            disks_objects = []
-            for disk in disks:
-                disks_objects.append(Disk(id=disk['id'], disk_size=disk["disk_size"], vm_id=disk['vm_id']))
-
-            return disks_objects
+            return await conn.fetch(SELECT_ALL_DISKS_QUERY)
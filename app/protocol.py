@@ -0,0 +1,29 @@
+import asyncio
+
+HEADER_SIZE = 4  # Size of the big-endian length prefix in bytes
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024  # Largest payload a peer may send or announce in the header
+
+
+async def send_message(writer: asyncio.StreamWriter, payload: bytes) -> None:
+    """
+    Sends one message framed as a 4-byte big-endian length followed by the payload.
+    Raises ValueError without writing anything if the payload is larger than MAX_MESSAGE_SIZE,
+    the peer would refuse it anyway
+    """
+    if len(payload) > MAX_MESSAGE_SIZE:
+        raise ValueError(f"Message of {len(payload)} bytes exceeds the {MAX_MESSAGE_SIZE} bytes limit")
+    writer.writelines((len(payload).to_bytes(HEADER_SIZE, "big"), payload))
+    await writer.drain()
+
+
+async def read_message(reader: asyncio.StreamReader) -> bytes:
+    """
+    Reads exactly one length-prefixed message from the stream.
+    Raises asyncio.IncompleteReadError if the connection is closed mid-message
+    and ValueError if the announced size is larger than MAX_MESSAGE_SIZE
+    """
+    header = await reader.readexactly(HEADER_SIZE)
+    size = int.from_bytes(header, "big")
+    if size > MAX_MESSAGE_SIZE:
+        raise ValueError(f"Message of {size} bytes exceeds the {MAX_MESSAGE_SIZE} bytes limit")
+    return await reader.readexactly(size)
@@ -1,15 +1,17 @@
-from typing import Literal, Optional, List, Tuple
-from pydantic import BaseModel, Field, model_validator
+from asyncio import StreamWriter
+from dataclasses import dataclass, field
+from typing import Annotated, Literal, Optional, List, Tuple, Union
+from pydantic import BaseModel, Field, TypeAdapter
 
-
-class Request(BaseModel):
-    """ Main scheme for client's requests validation """
-    command: Literal["ping", "register", "authenticate", "list", "update", "logout"]
-    data: Optional[dict] = dict()
+from config import MAX_BATCH_SIZE
 
 
 class Response(BaseModel):
-    """ Main scheme for server's responses to clients """
+    """
+    Main scheme for server's responses to clients.
+    Responses carrying large payloads built by the server itself are created with
+    Response.model_construct to skip re-validating the data
+    """
     status: Literal["success", "error"]
     message: Optional[str] = None
     data: Optional[dict] = dict()
@@ -24,38 +26,69 @@ class Disk(BaseModel):
 
 class VM(BaseModel):
     """ Main virtual machine data validation scheme """
-    vm_id: str = Field(..., description="Unique identifier for the virtual machine")
+    vm_id: str = Field(
+        ..., pattern=r"^\S+$", max_length=255, description="Unique identifier for the virtual machine, without spaces"
+    )
     ram: int = Field(..., gt=0, lt=32000, description="RAM size in MB (between 1MB and 2048MB)")
     cpu: int = Field(..., gt=0, lt=32, description="Number of CPU cores (between 1 and 32)")
     password: str = Field(..., min_length=8, max_length=100, description="Password for authentication")
     disks: List[Disk] = Field(..., description="List of disks associated with the VM")
 
-    @model_validator(mode="before")
-    @classmethod
-    def check_vm_id(cls, values):
-        if " " in values["vm_id"]:
-            raise ValueError("VM ID cannot contain spaces")
-        return values
+
+@dataclass(slots=True)
+class DiskRecord:
+    """ Disk loaded from the database. The data is trusted, so it skips pydantic validation """
+    id: int
+    vm_id: str
+    disk_size: int
+
+
+@dataclass(slots=True)
+class VMRecord:
+    """ Virtual machine loaded from the database together with its disks. Skips pydantic validation """
+    vm_id: str
+    ram: int
+    cpu: int
+    password: str
+    disks: List[DiskRecord] = field(default_factory=list)
+
+    def public_info(self) -> dict:
+        """
+        VM info that can be sent to clients, without the password hash.
+        The disk records are kept as they are: orjson and pydantic serialize dataclasses themselves
+        """
+        return {"vm_id": self.vm_id, "ram": self.ram, "cpu": self.cpu, "disks": self.disks}
+
+
+@dataclass(slots=True)
+class ClientState:
+    """
+    Server-side state of a connected client. vm_id and vm_info belong to the authenticated vm,
+    so commands don't have to decode the token or query the database for them
+    """
+    addr: Tuple[str, int]
+    writer: StreamWriter
+    token: Optional[str] = None
+    token_exp: Optional[int] = None
+    vm_id: Optional[str] = None
+    vm_info: Optional[dict] = None
 
 
 class AuthenticateVM(BaseModel):
     """ Scheme to receive user authentication data"""
     vm_id: str = Field(..., description="VM identifier (integer, greater than 0)")
     password: str = Field(..., min_length=8, max_length=100, description="VM authentication password")
-    addr: Optional[Tuple[str, int]] = None  # IP address and port as a tuple
 
 
 class ListVM(BaseModel):
     """ Scheme for the list command data validation. Needs the access token to let the command be run """
     token: str
-    addr: Optional[Tuple[str, int]] = None
     list_type: Literal["active_vms", "authenticated_vms", "all_vms", "all_disks"]
 
 
 class UpdateVM(BaseModel):
     """ Scheme for the update command data validation. Needs the access token to let the command be run """
     token: str
-    addr: Optional[Tuple[str, int]] = None
     ram: Optional[int] = Field(None, gt=0, description="Updated RAM size in MB")
     cpu: Optional[int] = Field(None, gt=0, lt=32, description="Updated number of CPU cores")
     disks: Optional[List[Disk]] = Field(None, description="List of disks associated with the VM")
@@ -64,4 +97,60 @@ class UpdateVM(BaseModel):
 class Logout(BaseModel):
     """ Scheme for the logout command data validation. Needs the access token to let the command be run """
     token: str
-    addr: Optional[Tuple[str, int]]
+
+
+class Batch(BaseModel):
+    """ Scheme for the batch command. Holds several requests to be run in one round-trip """
+    requests: List["Request"] = Field(
+        ..., min_length=1, max_length=MAX_BATCH_SIZE, description="Requests to run in their original order"
+    )
+
+
+class PingRequest(BaseModel):
+    command: Literal["ping"]
+    data: Optional[dict] = dict()
+
+
+class RegisterRequest(BaseModel):
+    command: Literal["register"]
+    data: VM
+
+
+class AuthenticateRequest(BaseModel):
+    command: Literal["authenticate"]
+    data: AuthenticateVM
+
+
+class ListRequest(BaseModel):
+    command: Literal["list"]
+    data: ListVM
+
+
+class UpdateRequest(BaseModel):
+    command: Literal["update"]
+    data: UpdateVM
+
+
+class LogoutRequest(BaseModel):
+    command: Literal["logout"]
+    data: Logout
+
+
+class BatchRequest(BaseModel):
+    command: Literal["batch"]
+    data: Batch
+
+
+# Main scheme for client's requests validation. The command field picks the request model,
+# so the payload is validated into its typed scheme in the same pass as the envelope
+Request = Annotated[
+    Union[PingRequest, RegisterRequest, AuthenticateRequest, ListRequest, UpdateRequest, LogoutRequest, BatchRequest],
+    Field(discriminator="command")
+]
+Batch.model_rebuild()
+BatchRequest.model_rebuild()
+
+
+# The request validator and the response serializer are built once and reused for every message
+REQUEST_ADAPTER = TypeAdapter(Request)
+RESPONSE_ADAPTER = TypeAdapter(Response)
@@ -1,11 +1,51 @@
-import json
 import asyncio
+import hmac
 import logging
+import time
+import orjson
 from pydantic import ValidationError
 
+try:
+    # libuv based event loop, much faster on socket I/O. It isn't available on Windows
+    import uvloop
+except ImportError:
+    uvloop = None
+
 from utils import Token
+from config import AUTH_RATE_LIMIT, AUTH_RATE_PERIOD, MAX_CLIENTS
+from protocol import MAX_MESSAGE_SIZE, send_message, read_message
 from database import DbPool, DatabaseManager, PasswordHandler
-from schemes import VM, Request, AuthenticateVM, Response, ListVM, Logout, UpdateVM, Disk
+from schemes import (
+    ClientState, Request, Response, VM, AuthenticateVM, ListVM, UpdateVM, Logout, Batch, REQUEST_ADAPTER,
+    RESPONSE_ADAPTER
+)
+
+
+log = logging.getLogger(__name__)
+
+PIPELINE_DEPTH = 16  # Requests read ahead from one client while an earlier one is still running
+
+# Responses that never change are built once and shared by every client
+NOT_AUTHENTICATED = Response(status="error", message="You have to authenticate to run this operation")
+INVALID_TOKEN = Response(
+    status="error", message="Invalid access token. Try refreshing with the 'authenticate' command"
+)
+TOKEN_EXPIRED = Response(
+    status="error", message="Access token expired. Try refreshing with the 'authenticate' command"
+)
+INVALID_CREDENTIALS = Response(status="error", message="Invalid credentials")
+RATE_LIMITED = Response(status="error", message="Too many authentication attempts. Try again later")
+NESTED_BATCH = Response(status="error", message="Nested batch commands are not allowed")
+SERVER_FULL = Response(status="error", message="Too many clients connected. Try again later")
+RESPONSE_TOO_LARGE = Response(status="error", message="Response is too large to be sent")
+# Their serialized form as well, looked up by the identity of the shared instance
+STATIC_PAYLOADS = {
+    id(response): RESPONSE_ADAPTER.dump_json(response)
+    for response in (
+        NOT_AUTHENTICATED, INVALID_TOKEN, TOKEN_EXPIRED, INVALID_CREDENTIALS, RATE_LIMITED, NESTED_BATCH, SERVER_FULL,
+        RESPONSE_TOO_LARGE
+    )
+}
 
 
 class VMServer:
@@ -16,129 +56,219 @@ class VMServer:
         Attributes:
             host (str): The server's IP address.
             port (int): The server's listening port.
-            active_clients (dict): A dictionary storing connected active
-            clients and authenticated clients with tokens.
-            commands (dict): A mapping of command strings to their respective handler methods.
+            active_clients (dict): A dictionary storing the ClientState of connected active
+            clients and authenticated clients with tokens, keyed by the id of the ClientState.
+            pool (asyncpg.Pool): The database connection pool shared by all commands. Set in init_db.
+            auth_attempts (dict): Start of the current rate limit window and the number of
+            authentication attempts made in it for every client host. Expired windows are swept once a period.
         """
 
         self.host = host
         self.port = port
         self.active_clients = {}
-        self.commands = {
-            "ping": self.ping,
-            "register": self.register,
-            "authenticate": self.authenticate,
-            "list": self.list,
-            "update": self.update,
-            "logout": self.logout
-        }
+        self.pool = None
+        self.auth_attempts = {}
+        self.auth_attempts_swept = time.monotonic()
 
     async def init_db(self) -> None:
         """ Initialize the database and create necessary tables """
-        connection_pool = await DbPool.create_pool()
-        logging.info(f'Database connection pool: {connection_pool}')
-        await DatabaseManager.create_tables(connection_pool)
+        self.pool = await DbPool.get_pool()
+        log.info('Database connection pool: %s', self.pool)
+        await DatabaseManager.create_tables(self.pool)
 
     async def start_server(self) -> None:
         """ Starts the server to accept commands """
         svr = await asyncio.start_server(self.handle_client, self.host, self.port)
-        logging.info(f'Server running on {self.host}:{self.port}')
+        log.info('Server running on %s:%s', self.host, self.port)
         async with svr:
             await svr.serve_forever()
 
     async def send_response(self, writer, response: Response) -> None:
-        response_data = response.model_dump_json() + "\n"
-        writer.write(response_data.encode())
-        await writer.drain()
+        payload = STATIC_PAYLOADS.get(id(response))
+        if payload is None:
+            # Response fields only hold plain JSON types, so orjson dumps them directly without walking the
+            # pydantic schema. Database records are dumped as mappings through default=dict.
+            # The adapter is kept for anything orjson can't serialize
+            try:
+                payload = orjson.dumps(response.__dict__, default=dict)
+            except orjson.JSONEncodeError:
+                payload = RESPONSE_ADAPTER.dump_json(response)
+            if len(payload) > MAX_MESSAGE_SIZE:
+                # The client would drop the connection on a frame over the limit, an error reply keeps it usable
+                log.warning('Response of %s bytes exceeds the message size limit', len(payload))
+                payload = STATIC_PAYLOADS[id(RESPONSE_TOO_LARGE)]
+        await send_message(writer, payload)
 
     async def handle_client(self, reader, writer):
         """
         Main client handler. Stores the clients address and tokens in active
         clients variable also listening to clients commands, The commands are accepted in the json format
-        that gets validated with pydantic schemes in the commands' logic.
+        that gets validated with pydantic schemes into a typed request before running the command.
         """
         addr: tuple[str, int] = writer.get_extra_info('peername')
-        self.active_clients[addr] = {"token": None, "writer": writer}
-        logging.info(f'Client connected: {addr}')
-
+        if len(self.active_clients) >= MAX_CLIENTS:
+            log.warning('Client refused, %s clients already connected: %s', MAX_CLIENTS, addr)
+            try:
+                await self.send_response(writer, SERVER_FULL)
+            except ConnectionError:
+                # The refused client may already be gone, the transport still has to be closed
+                pass
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+            return
+
+        client = ClientState(addr, writer)
+        # Keyed by the id of the state object: a plain int that stays unique while the client is stored.
+        # The socket fd can't be used, a broken socket is closed at once and its fd can go to a new client
+        client_id = id(client)
+        self.active_clients[client_id] = client
+        log.info('Client connected: %s', addr)
+
+        # The next requests are read and validated while an earlier one is still running.
+        # One worker runs them, so the responses go out in the order the requests came in
+        requests = asyncio.Queue(maxsize=PIPELINE_DEPTH)
+        worker = asyncio.create_task(self.run_requests(requests, client))
         while True:
             try:
-                user_message = await reader.read(4096)
-                if not user_message:
-                    break
+                user_message = await read_message(reader)
+                await requests.put(REQUEST_ADAPTER.validate_json(user_message))
 
-                message_data = json.loads(user_message.decode())
-                request = Request(**message_data)
-                request.data['addr'] = addr
-                response = await self.process_command(request)
-                await self.send_response(writer, response)
+            except asyncio.IncompleteReadError:
+                break
 
             except ValidationError as e:
-                logging.error(f"User {addr}: {e}")
-                await self.send_response(writer, Response(status="error", message=str(e)))
+                # The error text repeats the input, which may hold a password, so only the locations are logged
+                log.info("User %s sent an invalid request: %s", addr, [error["loc"] for error in e.errors()])
+                await requests.put(Response(status="error", message=str(e)))
                 continue
 
             except Exception as e:
-                logging.error(f"User {addr}: {e}")
+                log.error("User %s: %s", addr, e)
                 break
 
+        # Let the requests already read finish, so no started update is lost
+        await requests.put(None)
+        await worker
+
         writer.close()
-        self.active_clients.pop(addr, None)
-        await writer.wait_closed()
-        logging.info(f'Client disconnected: {addr}')
+        self.active_clients.pop(client_id, None)
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            # The connection already broke while sending, which has been logged
+            pass
+        log.info('Client disconnected: %s', addr)
 
-    async def process_command(self, request: Request) -> Response:
+    async def run_requests(self, requests: asyncio.Queue, client: ClientState) -> None:
         """
-        Validates and runs server commands
+        Runs the client's requests one at a time in the order they were read and sends the responses.
+        Validation errors come in the queue as ready responses. Stops at the None put after the last request
         """
-        try:
-            command = request.command.lower()
-            if command in self.commands:
-                return await self.commands[command](request.data)
+        connected = True
+        while (item := await requests.get()) is not None:
+            if not connected:
+                # The reader stops on its own once the connection is gone, just let it finish
+                continue
 
-            return Response(status="success", message="Unknown command")
+            response = item if isinstance(item, Response) else await self.process_command(item, client)
+            try:
+                await self.send_response(client.writer, response)
+            except Exception as e:
+                log.error("User %s: %s", client.addr, e)
+                connected = False
+
+    async def process_command(self, request: Request, client: ClientState) -> Response:
+        """
+        Runs a validated server command for the client
+        """
+        try:
+            return await self.COMMANDS[request.command](self, request.data, client)
 
         except Exception as e:
-            return Response(status="error", message=str(e), data=request.data)
+            return Response(status="error", message=str(e))
 
-    async def ping(self, request_data: dict) -> Response:
+    async def ping(self, request_data: dict, client: ClientState) -> Response:
         """
         A method for the client to check if the server is running
         """
-        logging.info(f"User: {request_data['addr']} pings")
+        log.debug("User %s pings", client.addr)
         return Response(status="success", message=f"PONG", data=request_data)
 
-    async def register(self, request_data: dict) -> Response:
+    async def register(self, vm: VM, client: ClientState) -> Response:
         """
-        A method for the client to register a new vm machine. Uses VM pydantic scheme for validation
+        A method for the client to register a new vm machine. The data arrives validated with the VM scheme
         """
-        vm = VM(**request_data)
-        connection_pool = await DbPool.get_pool()
-        await DatabaseManager.create_vm(connection_pool, vm)
-        logging.info(f"Registered VM: {vm.model_dump(exclude={'password'})}")
+        await DatabaseManager.create_vm(self.pool, vm)
+        log.info("Registered VM: %s", vm.vm_id)
 
         return Response(status="success", message="Save the vm_id for authentication", data={"auth_id": vm.vm_id})
 
-    async def authenticate(self, request_data: dict) -> Response:
+    async def authenticate(self, auth_data: AuthenticateVM, client: ClientState) -> Response:
         """
         Authenticates the user and sends him a jwt token to gain access to protected commands
         """
-        auth_data = AuthenticateVM(**request_data)
-        connection_pool = await DbPool.get_pool()
+        if self.is_rate_limited(client.addr[0]):
+            log.warning('Authentication rate limited: %s', client.addr)
+            return RATE_LIMITED
 
-        vm = await DatabaseManager.get_vm(connection_pool, auth_data.vm_id)
-        if vm and PasswordHandler.verify_password(auth_data.password, vm.password):
-            self.active_clients[auth_data.addr]["token"] = Token.generate_token(vm.vm_id)
-            logging.info(f'Authenticated user: {auth_data.addr} vm_id: {vm.vm_id}')
+        vm = await DatabaseManager.get_vm(self.pool, auth_data.vm_id)
+        if vm and await PasswordHandler.verify_password_async(auth_data.password, vm.password):
+            client.token, client.token_exp = Token.generate_token(vm.vm_id)
+            client.vm_id = vm.vm_id
+            client.vm_info = vm.public_info()
+            log.info('Authenticated user: %s vm_id: %s', client.addr, vm.vm_id)
 
             return Response(
                 status="success", message="Authentication successful",
-                data={"token": self.active_clients[auth_data.addr]['token']}
+                data={"token": client.token}
             )
 
-        return Response(status="error", message="Invalid credentials")
+        return INVALID_CREDENTIALS
+
+    @staticmethod
+    def check_access(client: ClientState, token: str) -> Response | None:
+        """
+        Checks the token sent with a protected command against the one issued to the client.
+        Returns the error response if the access is denied. The tokens are compared in constant time,
+        and the expiration stored at authentication is checked instead of decoding the token again
+        """
+        if client.token is None:
+            return NOT_AUTHENTICATED
+
+        if not hmac.compare_digest(client.token.encode(), token.encode()):
+            return INVALID_TOKEN
+
+        if time.time() >= client.token_exp:
+            return TOKEN_EXPIRED
 
-    async def list(self, request_data: dict) -> Response:
+        return None
+
+    def is_rate_limited(self, host: str) -> bool:
+        """
+        Counts an authentication attempt from the host and tells if it's over AUTH_RATE_LIMIT for the current period.
+        The limit is kept per host rather than per connection, so reconnecting doesn't reset it
+        """
+        now = time.monotonic()
+        if now - self.auth_attempts_swept >= AUTH_RATE_PERIOD:
+            # Hosts whose window has ended are under no limit anymore. Dropping them once a period
+            # keeps only the hosts seen lately, so rotating source addresses can't grow the dict without end
+            self.auth_attempts = {
+                known_host: entry for known_host, entry in self.auth_attempts.items()
+                if now - entry[0] < AUTH_RATE_PERIOD
+            }
+            self.auth_attempts_swept = now
+
+        window_start, attempts = self.auth_attempts.get(host, (now, 0))
+        if now - window_start >= AUTH_RATE_PERIOD:
+            window_start, attempts = now, 0
+
+        self.auth_attempts[host] = (window_start, attempts + 1)
+        return attempts >= AUTH_RATE_LIMIT
+
+    async def list(self, command_data: ListVM, client: ClientState) -> Response:
         """
         A protected command to display info from the server. Available only for authenticated users.
         They can list:
@@ -147,118 +277,148 @@ class VMServer:
         - all virtual machines (command: all_vms)
         - all disks (command: all_disks)
         """
-        command_data = ListVM(**request_data)
-        auth_token = self.active_clients[command_data.addr]["token"]
-        if auth_token is None:
-            return Response(status="error", message="You have to authenticate to run this operation")
+        access_error = self.check_access(client, command_data.token)
+        if access_error:
+            return access_error
 
-        if auth_token != command_data.token:
-            return Response(
-                status="error", message="Invalid access token. Try refreshing with the 'authenticate' command"
-            )
-
-        user_vm_id = Token.get_vm_id(auth_token)
+        user_vm_id = client.vm_id
 
         if command_data.list_type == "active_vms":
-            logging.info(f"VM({user_vm_id}): active_vms command")
+            log.debug("VM(%s): active_vms command", user_vm_id)
             active, _ = await self.get_users()
 
-            return Response(status="success", data={"active_vms": active})
+            return Response.model_construct(status="success", data={"active_vms": active})
 
         elif command_data.list_type == "authenticated_vms":
-            logging.info(f"VM({user_vm_id}): authenticated_vms command")
+            log.debug("VM(%s): authenticated_vms command", user_vm_id)
             _, authenticated = await self.get_users()
 
-            return Response(status="success", data={"authenticated_vms": authenticated})
+            return Response.model_construct(status="success", data={"authenticated_vms": authenticated})
 
         elif command_data.list_type == "all_vms":
-            logging.info(f"VM({user_vm_id}): all_vms command")
-            connection_pool = await DbPool.get_pool()
-            vms = await DatabaseManager.get_vms(connection_pool)
+            log.debug("VM(%s): all_vms command", user_vm_id)
+            vms = [vm async for vm in DatabaseManager.iter_public_vms(self.pool)]
 
-            return Response(
-                status="success",
-                data={"all_vms": [vm.model_dump(exclude_none=True, exclude={"password"}) for vm in vms]}
-            )
+            return Response.model_construct(status="success", data={"all_vms": vms})
 
         elif command_data.list_type == "all_disks":
-            logging.info(f"VM({user_vm_id}): all_disks command")
-            connection_pool = await DbPool.get_pool()
-            discs = await DatabaseManager.get_disks(connection_pool)
+            log.debug("VM(%s): all_disks command", user_vm_id)
+            discs = await DatabaseManager.get_disks(self.pool)
 
-            return Response(status="success",
-                            data={"all_disks": [disc.model_dump(exclude_none=True) for disc in discs]})
+            return Response.model_construct(status="success", data={"all_disks": discs})
 
         else:
-            logging.info(f"VM({user_vm_id}): unknown list command type")
+            log.debug("VM(%s): unknown list command type", user_vm_id)
             return Response(status="error", message="Unknown list command type")
 
     async def get_users(self) -> tuple[list, list]:
         """
-        Returns all active users and authenticated users with their virtual machine info
+        Returns all active users and authenticated users with their virtual machine info.
+        The info is cached on the client at authentication and refreshed on update, so no database calls are made
         """
         active_vms = []
         authenticated_vms = []
-        connection_pool = await DbPool.get_pool()
-        for addr, auth_data in self.active_clients.items():
-            token = auth_data.get("token")
-
-            if token:
-                vm: VM = await DatabaseManager.get_vm(connection_pool, Token.get_vm_id(token))
-                vm_info = vm.model_dump(exclude_none=True, exclude={'password'}) if vm else dict()
-                active_vms.append({"addr": addr, "vm_info": vm_info})
-                authenticated_vms.append({"addr": addr, "vm_info": vm_info})
+        for client in self.active_clients.values():
+            if client.token:
+                vm_info = client.vm_info
+                active_vms.append({"addr": client.addr, "vm_info": vm_info})
+                authenticated_vms.append({"addr": client.addr, "vm_info": vm_info})
 
             else:
-                active_vms.append({"addr": addr})
+                active_vms.append({"addr": client.addr})
 
         return active_vms, authenticated_vms
 
-    async def update(self, request_data: dict) -> Response:
+    async def update(self, command_data: UpdateVM, client: ClientState) -> Response:
         """
         Updates virtual machine info (ram, cpu, disks) for the authenticated user
         """
-        command_data = UpdateVM(**request_data)
+        access_error = self.check_access(client, command_data.token)
+        if access_error:
+            return access_error
 
-        auth_token = self.active_clients[command_data.addr]["token"]
-        if auth_token is None:
-            return Response(status="error", message="You have to authenticate to run this operation")
-
-        if auth_token != command_data.token:
-            return Response(
-                status="error", message="Invalid access token. Try refreshing with the 'authenticate' command"
-            )
-
-        vm_id = Token.get_vm_id(auth_token)
+        vm_id = client.vm_id
         try:
-            connection_pool = await DbPool.get_pool()
-            await DatabaseManager.update_vm(connection_pool, vm_id, command_data)
-            logging.info(f"Updated virtual machine info for vm: {vm_id}")
-            return Response(status="success", message="VM info updated successfully")
-
+            await DatabaseManager.update_vm(self.pool, vm_id, command_data)
+            log.debug("Updated virtual machine info for vm: %s", vm_id)
         except Exception as e:
-            logging.info(f"Error updating virtual machine info for vm: {vm_id}, {e}")
+            log.error("Error updating virtual machine info for vm: %s, %s", vm_id, e)
             return Response(status="error", message=str(e))
 
-    async def logout(self, request_data: dict):
-        command_data = Logout(**request_data)
-        auth_token = self.active_clients[command_data.addr]["token"]
-        if auth_token is None:
-            return Response(status="error", message="You have to authenticate to run this operation")
+        # The update is committed at this point, a failed reload only leaves the listed info stale
+        try:
+            await self.refresh_vm_info(vm_id)
+        except Exception as e:
+            log.error("Error refreshing cached virtual machine info for vm: %s, %s", vm_id, e)
+        return Response(status="success", message="VM info updated successfully")
+
+    async def refresh_vm_info(self, vm_id: str) -> None:
+        """ Reloads the cached vm info of every client authenticated with the vm """
+        vm = await DatabaseManager.get_vm(self.pool, vm_id)
+        vm_info = vm.public_info() if vm else dict()
+        for client in self.active_clients.values():
+            if client.vm_id == vm_id:
+                client.vm_info = vm_info
+
+    async def logout(self, command_data: Logout, client: ClientState) -> Response:
+        access_error = self.check_access(client, command_data.token)
+        if access_error:
+            return access_error
+
+        vm_id = client.vm_id
+        client.token = None
+        client.token_exp = None
+        client.vm_id = None
+        client.vm_info = None
+
+        log.info("Logged out user: %s", vm_id)
+        return Response(status="success", message=f"VM ({vm_id}) logged out successfully")
+
+    async def batch(self, command_data: Batch, client: ClientState) -> Response:
+        """
+        Runs several commands sent in one message in their original order.
+        Stops at the first failed command and returns the responses collected so far
+        """
+        responses = []
+        for request in command_data.requests:
+            if request.command == "batch":
+                responses.append(NESTED_BATCH.model_dump())
+                break
+
+            response = await self.process_command(request, client)
+            responses.append(response.model_dump())
+            if response.status == "error":
+                break
 
-        if auth_token != command_data.token:
-            return Response(
-                status="error", message="Invalid access token. Try refreshing with the 'authenticate' command"
-            )
+        return Response.model_construct(status=responses[-1]["status"], data={"responses": responses})
 
-        vm_id = Token.get_vm_id(auth_token)
-        self.active_clients[command_data.addr]["token"] = None
+    # A mapping of command strings to their handlers, built once with the class.
+    # The Request union only accepts these command names, so every validated request has a handler
+    COMMANDS = {
+        "ping": ping,
+        "register": register,
+        "authenticate": authenticate,
+        "list": list,
+        "update": update,
+        "logout": logout,
+        "batch": batch
+    }
 
-        logging.info(f"Logged out user: {vm_id}")
-        return Response(status="success", message=f"VM ({vm_id}) logged out successfully")
+
+async def main(server: VMServer) -> None:
+    """ Prepares the database and serves clients in one event loop, which the connection pool is bound to """
+    await server.init_db()
+    try:
+        await server.start_server()
+    finally:
+        # Close the database connections while their loop is still running
+        await DbPool.terminate_pool()
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     server = VMServer(host='0.0.0.0', port=8888)
-    asyncio.run(server.init_db())
-    asyncio.run(server.start_server())
+    if uvloop is not None:
+        uvloop.run(main(server))
+    else:
+        asyncio.run(main(server))
@@ -1,22 +1,31 @@
-import jwt
-import datetime
-from config import SECRET_KEY
+import time
+import hmac
+import base64
+import hashlib
+import orjson
+from config import SECRET_KEY, TOKEN_TTL
+
+
+def b64url_encode(data: bytes) -> bytes:
+    """ Base64url encoding without padding as used in JWT """
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
 
 class Token:
+    # The header never changes and the HMAC key schedule is set up once, so issuing a token
+    # only encodes the claims and signs them with a copy of the prepared HMAC object
+    HEADER = b64url_encode(b'{"alg":"HS256","typ":"JWT"}')
+    SIGNER = hmac.new(SECRET_KEY.encode(), digestmod=hashlib.sha256)
+
     @staticmethod
-    def generate_token(vm_id):
+    def generate_token(vm_id) -> tuple[str, int]:
+        """ Returns the token together with its expiration, so the issuer doesn't have to decode it back """
         payload = {
             "vm_id": vm_id,
-            "exp": datetime.datetime.utcnow() + datetime.timedelta(hours=1)  # Token expiration
+            "exp": int(time.time()) + TOKEN_TTL  # Token expiration
         }
-        token = jwt.encode(payload, SECRET_KEY, algorithm="HS256")
-        return token
-
-    @staticmethod
-    def decode_token(token):
-        return jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
-
-    @staticmethod
-    def get_vm_id(token):
-        payload = Token.decode_token(token)
-        return payload["vm_id"]
\ No newline at end of file
+        signing_input = Token.HEADER + b"." + b64url_encode(orjson.dumps(payload))
+        signer = Token.SIGNER.copy()
+        signer.update(signing_input)
+        token = signing_input + b"." + b64url_encode(signer.digest())
+        return token.decode(), payload["exp"]